@@ -3,24 +3,72 @@
 import time
 import hashlib
 import struct
-import binascii
+from hmac import compare_digest as _ct_eq
+import asyncio
+import concurrent.futures
+import logging
+import secrets
+import threading
 
-try:
-    import board
-    import busio
-    from adafruit_atecc import ATECC
-    ADAFRUIT_ATECC_AVAILABLE = True
-except ImportError:
-    ADAFRUIT_ATECC_AVAILABLE = False
+# Resolved on first connect(); importing board probes the pin layout, which is slow
+ADAFRUIT_ATECC_AVAILABLE = None
+
+logger = logging.getLogger(__name__)
+
+_U32_LE = struct.Struct('<I')
+# Largest value a monotonic counter can hold
+_COUNTER_MAX = 2097151
+# Slot 12 once the legacy count has been folded in: marker, offset, padding
+_COUNTER_MIGRATED = b'SIGNCTR1'
+_COUNTER_RECORD = struct.Struct('<8sI20x')
+_ZERO16 = bytes(16)
+_SIM_SERIAL = bytes.fromhex('0123456789ABCDEFEE')
+
+def _pick_sha256():
+    # hashlib built against OpenSSL picks up the ARMv8 SHA2 / SHA-NI code paths;
+    # otherwise prefer cryptography's OpenSSL binding over the builtin fallback
+    if hashlib.sha256.__module__ == '_hashlib':
+        return lambda data: hashlib.sha256(data).digest()
+    try:
+        from cryptography.hazmat.primitives import hashes
+    except ImportError:
+        return lambda data: hashlib.sha256(data).digest()
+    
+    def sha256(data):
+        digest = hashes.Hash(hashes.SHA256())
+        digest.update(data)
+        return digest.finalize()
+    return sha256
+
+_sha256 = _pick_sha256()
+
+def _load_adafruit():
+    global board, busio, ATECC, ADAFRUIT_ATECC_AVAILABLE
+    if ADAFRUIT_ATECC_AVAILABLE is None:
+        try:
+            import board
+            import busio
+            from adafruit_atecc import ATECC
+            ADAFRUIT_ATECC_AVAILABLE = True
+        except ImportError:
+            ADAFRUIT_ATECC_AVAILABLE = False
+    return ADAFRUIT_ATECC_AVAILABLE
 
 class ATECC608B:
+    # Data slots nothing else writes, so reads can be served from RAM
+    CACHED_SLOTS = {10, 11}
+    
     def __init__(self, i2c_address=0x60):
         self.i2c_address = i2c_address
         self.is_initialized = False
-        self.use_adafruit = ADAFRUIT_ATECC_AVAILABLE
+        self.use_adafruit = False
         self.atecc = None
+        self.sim_counters = [0, 0]
+        self._sha_lock = threading.Lock()
+        self._slot_cache = {}
         
     def connect(self):
+        self.use_adafruit = _load_adafruit()
         if not self.use_adafruit:
             self.is_initialized = True
             return True
@@ -31,102 +79,129 @@ class ATECC608B:
             self.is_initialized = True
             return True
         except Exception as e:
-            print(f"ATECC608B connection failed: {e}")
+            logger.warning("ATECC608B connection failed: %s", e)
             return False
             
     def disconnect(self):
         self.is_initialized = False
         self.atecc = None
+        self._slot_cache.clear()
             
     def get_serial_number(self):
         if not self.is_initialized:
             return None
         if not self.use_adafruit:
-            return bytearray([0x01, 0x23, 0x45, 0x67, 0x89, 0xAB, 0xCD, 0xEF, 0xEE])
+            return bytearray(_SIM_SERIAL)
             
         try:
             return self.atecc.serial_number
         except:
             return None
     
-    def get_random(self):
+    def _issue(self, op, *args, **kwargs):
+        method, failure, simulate = _OPS[op]
         if not self.is_initialized:
-            return None
+            return failure
         if not self.use_adafruit:
-            import random
-            return bytearray([random.randint(0, 255) for _ in range(32)])
+            return simulate(self, *args, **kwargs)
             
         try:
-            return self.atecc.random()
+            return getattr(self.atecc, method)(*args, **kwargs)
         except:
-            return None
+            return failure
     
-    def generate_key_pair(self, slot=0):
-        if not self.is_initialized:
-            return None
-        if not self.use_adafruit:
-            import random
-            return bytearray([random.randint(0, 255) for _ in range(64)])
+    def _simulate_counter(self, counter_id, increment_counter):
+        if increment_counter:
+            self.sim_counters[counter_id] += 1
+        return bytearray(_U32_LE.pack(self.sim_counters[counter_id]))
+    
+    def sha256(self, data):
+        if not self.is_initialized or not self.use_adafruit:
+            return _sha256(data)
             
-        try:
-            return self.atecc.gen_key(slot, private_key=True)
-        except:
-            return None
+        view = memoryview(data)
+        end = len(view) - len(view) % 64
+        with self._sha_lock:
+            try:
+                self.atecc.sha_start()
+                for offset in range(0, end, 64):
+                    self.atecc.sha_update(bytearray(view[offset:offset + 64]))
+                # sha_digest only treats a bytearray as a message (anything
+                # else is packed as a single byte), even for an empty tail
+                return bytes(self.atecc.sha_digest(bytearray(view[end:])))
+            except (OSError, RuntimeError):
+                return _sha256(data)
+    
+    def get_random(self):
+        return self._issue('random')
+    
+    def generate_key_pair(self, slot=0):
+        return self._issue('gen_key', slot, private_key=True)
     
     def get_public_key(self, slot=0):
-        if not self.is_initialized:
-            return None
-        if not self.use_adafruit:
-            import random
-            return bytearray([random.randint(0, 255) for _ in range(64)])
-            
-        try:
-            return self.atecc.get_public_key(slot)
-        except:
-            return None
+        return self._issue('get_public_key', slot)
     
     def sign_data(self, slot, data):
-        if not self.is_initialized:
-            return None
         if len(data) != 32:
-            data = hashlib.sha256(data).digest()
-        
-        if not self.use_adafruit:
-            import random
-            return bytearray([random.randint(0, 255) for _ in range(64)])
-        
-        try:
-            return self.atecc.sign(slot, data)
-        except:
-            return None
+            data = _sha256(data)
+        return self._issue('sign', slot, data)
     
     def write_data_slot(self, slot, data):
         if not self.is_initialized:
             return False
-        if not self.use_adafruit:
-            return True
-            
-        try:
-            self.atecc.write(slot, data)
-            return True
-        except:
-            return False
+        if self.use_adafruit:
+            try:
+                self.atecc.write(slot, data)
+            except:
+                self._slot_cache.pop(slot, None)
+                return False
+                
+        if slot in self.CACHED_SLOTS:
+            self._slot_cache[slot] = bytes(data)
+        return True
     
     def read_data_slot(self, slot, length=32):
-        if not self.is_initialized:
-            return None
-        if not self.use_adafruit:
-            return bytearray([0] * length)
+        cached = self._slot_cache.get(slot)
+        if cached is not None and len(cached) >= length and self.is_initialized:
+            # Read-only view of the cached bytes; no copy on the hot path
+            return memoryview(cached)[:length]
             
-        try:
-            return self.atecc.read(slot, length)
-        except:
-            return None
+        data = self._issue('read', slot, length)
+        if data is not None and slot in self.CACHED_SLOTS:
+            self._slot_cache[slot] = bytes(data)
+        return data
+    
+    def counter_increment(self, counter_id=0):
+        return self._issue('counter', counter_id, increment_counter=True)
+    
+    def counter_read(self, counter_id=0):
+        return self._issue('counter', counter_id, increment_counter=False)
+
+# op: (adafruit_atecc method, result on failure, simulated result); the
+# simulations get the ATECC608B wrapper, not the adafruit driver
+_OPS = {
+    'random': ('random', None,
+               lambda device: bytearray(secrets.token_bytes(32))),
+    'gen_key': ('gen_key', None,
+                lambda device, slot, private_key: bytearray(secrets.token_bytes(64))),
+    'get_public_key': ('get_public_key', None,
+                       lambda device, slot: bytearray(secrets.token_bytes(64))),
+    'sign': ('sign', None,
+             lambda device, slot, data: bytearray(secrets.token_bytes(64))),
+    'read': ('read', None,
+             lambda device, slot, length: bytearray(length)),
+    'counter': ('counter', None,
+                lambda device, counter_id, increment_counter: device._simulate_counter(counter_id, increment_counter)),
+}
 
 class SecureKeyStorage:
     def __init__(self):
         self.atecc = ATECC608B()
         self.is_initialized = False
+        self.sign_counter_id = 0
+        self._counter_mirror = None
+        self._counter_offset = 0
+        self._digest_cache = {}
         
         self.key_slots = {
             0: 'device_identity',
@@ -155,27 +230,68 @@ class SecureKeyStorage:
             return False
             
         self.is_initialized = True
+        self._counter_mirror = None
+        self.get_sign_counter()
+        self._load_counter_offset()
         return True
     
+    def _load_counter_offset(self):
+        # Older builds kept the sign count in data slot 12. Relying parties
+        # treat a count that goes backwards as a cloned key, so the old value
+        # becomes a fixed offset on top of hardware counter 0. It is worked
+        # out once and kept behind a marker; the chip's counter can only step
+        # by one, so it is never advanced to catch up
+        self._counter_offset = 0
+        data = self.atecc.read_data_slot(12, 32)
+        if not data or self._counter_mirror is None:
+            return
+        data = bytes(data)
+        marker, offset = _COUNTER_RECORD.unpack(data)
+        if marker == _COUNTER_MIGRATED:
+            self._counter_offset = offset
+            return
+        legacy_count = _U32_LE.unpack_from(data)[0]
+        # The reported count must still fit the 4-byte signCount
+        offset = min(max(0, legacy_count - self._counter_mirror), 0xFFFFFFFF - _COUNTER_MAX)
+        if self._write_counter_record(offset):
+            self._counter_offset = offset
+    
+    def _write_counter_record(self, offset):
+        return self.atecc.write_data_slot(12, _COUNTER_RECORD.pack(_COUNTER_MIGRATED, offset))
+    
     def cleanup(self):
         if self.atecc:
             self.atecc.disconnect()
         self.is_initialized = False
+        self._counter_mirror = None
+    
+    def _digest(self, text):
+        digest = self._digest_cache.get(text)
+        if digest is None:
+            if len(self._digest_cache) >= 128:
+                self._digest_cache.clear()
+            digest = self.atecc.sha256(text.encode())
+            self._digest_cache[text] = digest
+        return digest
     
     def get_device_serial(self):
         if not self.is_initialized:
             return None
         serial = self.atecc.get_serial_number()
         if serial:
-            return binascii.hexlify(bytes(serial)).decode()
+            return bytes(serial)
         return None
     
+    def get_device_serial_hex(self):
+        serial = self.get_device_serial()
+        return serial.hex() if serial else None
+    
     def generate_device_key(self, slot=0):
         if not self.is_initialized:
             return None
         public_key = self.atecc.generate_key_pair(slot)
         if public_key:
-            return binascii.hexlify(bytes(public_key)).decode()
+            return bytes(public_key)
         return None
     
     def sign_with_device_key(self, slot, data):
@@ -183,11 +299,11 @@ class SecureKeyStorage:
             return None
             
         if len(data) != 32:
-            data = hashlib.sha256(data).digest()
+            data = _sha256(data)
         
-        signature = self.atecc.sign_data(slot, list(data))
+        signature = self.atecc.sign_data(slot, data)
         if signature:
-            return binascii.hexlify(bytes(signature)).decode()
+            return bytes(signature)
         return None
     
     def get_hardware_random(self):
@@ -195,7 +311,7 @@ class SecureKeyStorage:
             return None
         random_data = self.atecc.get_random()
         if random_data:
-            return binascii.hexlify(bytes(random_data)).decode()
+            return bytes(random_data)
         return None
     
     def store_credential_id(self, slot, cred_id):
@@ -203,7 +319,7 @@ class SecureKeyStorage:
             return False
         
         padded_data = cred_id.ljust(32, b'\x00')
-        return self.atecc.write_data_slot(slot, list(padded_data))
+        return self.atecc.write_data_slot(slot, padded_data)
     
     def retrieve_credential_id(self, slot):
         if not self.is_initialized:
@@ -211,15 +327,19 @@ class SecureKeyStorage:
         
         data = self.atecc.read_data_slot(slot, 32)
         if data:
-            return bytes(data).rstrip(b'\x00')
+            view = memoryview(data)
+            end = len(view)
+            while end and view[end - 1] == 0:
+                end -= 1
+            return bytes(view[:end])
         return None
     
     def store_rp_hash(self, slot, rp_id):
         if not self.is_initialized:
             return False
         
-        rp_hash = hashlib.sha256(rp_id.encode()).digest()
-        return self.atecc.write_data_slot(slot, list(rp_hash))
+        rp_hash = self._digest(rp_id)
+        return self.atecc.write_data_slot(slot, rp_hash)
     
     def verify_rp_hash(self, slot, rp_id):
         if not self.is_initialized:
@@ -227,17 +347,29 @@ class SecureKeyStorage:
         
         stored_hash = self.atecc.read_data_slot(slot, 32)
         if stored_hash:
-            current_hash = hashlib.sha256(rp_id.encode()).digest()
-            return bytes(stored_hash) == current_hash
+            current_hash = self._digest(rp_id)
+            return _ct_eq(stored_hash, current_hash)
         return False
     
+    def verify_rp_hash_across(self, slots, rp_id):
+        if not self.is_initialized:
+            return []
+        
+        current_hash = self._digest(rp_id)
+        matches = []
+        for slot in slots:
+            stored_hash = self.atecc.read_data_slot(slot, 32)
+            if stored_hash and _ct_eq(stored_hash, current_hash):
+                matches.append(slot)
+        return matches
+    
     def store_fingerprint_template_hash(self, template_data):
         if not self.is_initialized:
             return False
         
         slot = 10
-        template_hash = hashlib.sha256(template_data.encode()).digest()
-        return self.atecc.write_data_slot(slot, list(template_hash))
+        template_hash = self._digest(template_data)
+        return self.atecc.write_data_slot(slot, template_hash)
     
     def verify_fingerprint_template_hash(self, template_data):
         if not self.is_initialized:
@@ -246,38 +378,31 @@ class SecureKeyStorage:
         slot = 10
         stored_hash = self.atecc.read_data_slot(slot, 32)
         if stored_hash:
-            current_hash = hashlib.sha256(template_data.encode()).digest()
-            return bytes(stored_hash) == current_hash
+            current_hash = self._digest(template_data)
+            return _ct_eq(stored_hash, current_hash)
         return False
     
-    def increment_sign_counter(self, rp_id):
+    def increment_sign_counter(self):
         if not self.is_initialized:
             return 0
         
-        slot = 12
-        counter_data = self.atecc.read_data_slot(slot, 4)
+        counter_data = self.atecc.counter_increment(self.sign_counter_id)
         
         if counter_data:
-            current_count = struct.unpack('<I', bytes(counter_data))[0]
-        else:
-            current_count = 0
-        
-        new_count = current_count + 1
-        counter_bytes = list(struct.pack('<I', new_count))
-        
-        if self.atecc.write_data_slot(slot, counter_bytes):
-            return new_count
-        return current_count
+            self._counter_mirror = _U32_LE.unpack(counter_data)[0]
+        return self.get_sign_counter()
     
     def get_sign_counter(self):
         if not self.is_initialized:
             return 0
+        if self._counter_mirror is not None:
+            return self._counter_mirror + self._counter_offset
         
-        slot = 12
-        counter_data = self.atecc.read_data_slot(slot, 4)
+        counter_data = self.atecc.counter_read(self.sign_counter_id)
         
         if counter_data:
-            return struct.unpack('<I', bytes(counter_data))[0]
+            self._counter_mirror = _U32_LE.unpack(counter_data)[0]
+            return self._counter_mirror + self._counter_offset
         return 0
     
     def store_device_aaguid(self, aaguid_bytes):
@@ -285,8 +410,8 @@ class SecureKeyStorage:
             return False
         
         slot = 11
-        padded_data = list(aaguid_bytes) + [0] * 16
-        return self.atecc.write_data_slot(slot, padded_data[:32])
+        padded_data = bytes(aaguid_bytes) + _ZERO16
+        return self.atecc.write_data_slot(slot, padded_data)
     
     def get_device_aaguid(self):
         if not self.is_initialized:
@@ -304,7 +429,12 @@ class SecureKeyStorage:
         
         random_data = self.atecc.get_random()
         if random_data:
-            return self.atecc.write_data_slot(slot, list(random_data))
+            if not self.atecc.write_data_slot(slot, random_data):
+                return False
+            if slot == 12:
+                # Keep the sign count floor; a reset must not move it backwards
+                return self._write_counter_record(self._counter_offset)
+            return True
         return False
     
     def health_check(self):
@@ -312,10 +442,76 @@ class SecureKeyStorage:
             return False
         
         test_random = self.get_hardware_random()
-        return test_random is not None and len(test_random) == 64
+        return test_random is not None and len(test_random) == 32
 
 def get_secure_storage_instance():
     storage = SecureKeyStorage()
     if storage.initialize():
         return storage
     return None
+
+class AsyncSecureKeyStorage:
+    def __init__(self, storage=None):
+        self.storage = storage if storage is not None else SecureKeyStorage()
+        # One worker keeps ATECC commands serialized; the chip runs one at a time
+        self._exec = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._exec, func, *args)
+    
+    async def initialize(self):
+        return await self._run(self.storage.initialize)
+    
+    async def cleanup(self):
+        await self._run(self.storage.cleanup)
+        self._exec.shutdown(wait=False)
+    
+    async def get_device_serial(self):
+        return await self._run(self.storage.get_device_serial)
+    
+    async def get_device_serial_hex(self):
+        return await self._run(self.storage.get_device_serial_hex)
+    
+    async def generate_device_key(self, slot=0):
+        return await self._run(self.storage.generate_device_key, slot)
+    
+    async def sign_with_device_key(self, slot, data):
+        return await self._run(self.storage.sign_with_device_key, slot, data)
+    
+    async def get_hardware_random(self):
+        return await self._run(self.storage.get_hardware_random)
+    
+    async def store_credential_id(self, slot, cred_id):
+        return await self._run(self.storage.store_credential_id, slot, cred_id)
+    
+    async def retrieve_credential_id(self, slot):
+        return await self._run(self.storage.retrieve_credential_id, slot)
+    
+    async def store_rp_hash(self, slot, rp_id):
+        return await self._run(self.storage.store_rp_hash, slot, rp_id)
+    
+    async def verify_rp_hash(self, slot, rp_id):
+        return await self._run(self.storage.verify_rp_hash, slot, rp_id)
+    
+    async def verify_rp_hash_across(self, slots, rp_id):
+        return await self._run(self.storage.verify_rp_hash_across, slots, rp_id)
+    
+    async def increment_sign_counter(self):
+        return await self._run(self.storage.increment_sign_counter)
+    
+    async def get_sign_counter(self):
+        return await self._run(self.storage.get_sign_counter)
+    
+    async def get_device_aaguid(self):
+        return await self._run(self.storage.get_device_aaguid)
+    
+    async def secure_delete_slot(self, slot):
+        return await self._run(self.storage.secure_delete_slot, slot)
+
+async def get_async_secure_storage_instance():
+    storage = AsyncSecureKeyStorage()
+    if await storage.initialize():
+        return storage
+    await storage.cleanup()
+    return None
@@ -2,13 +2,28 @@
 
 import sys
 import time
-import os
-from r503_fingerprint import FingerprintAuth
+import atexit
+from user_mappings import UserMappings
 
 class FingerprintManager:
     def __init__(self):
-        self.fp_auth = FingerprintAuth()
-        self.mapping_file = "/etc/fido2_security_key/user_mappings.txt"
+        from r503_fingerprint import FingerprintAuth
+        self.fp_auth = FingerprintAuth(exclusive=True)
+        self.mappings = UserMappings()
+        self.sensor_ready = self.fp_auth.initialize()
+        atexit.register(self.fp_auth.cleanup)
+        
+    def ensure_sensor(self):
+        if not self.sensor_ready:
+            self.sensor_ready = self.fp_auth.initialize()
+        return self.sensor_ready
+        
+    def sensor_error(self, e):
+        print(f"Error: {e}")
+        if isinstance(e, OSError):
+            # Drop the port so the next action reopens it and re-handshakes
+            self.fp_auth.cleanup()
+            self.sensor_ready = False
         
     def display_menu(self):
         print("\n" + "=" * 50)
@@ -26,7 +41,7 @@ class FingerprintManager:
         print("\n📊 Enrolled Fingerprints")
         print("-" * 30)
         
-        if not self.fp_auth.initialize():
+        if not self.ensure_sensor():
             print("❌ Could not initialize fingerprint sensor")
             return
             
@@ -39,34 +54,26 @@ class FingerprintManager:
                 return
                 
             # Show user mappings if available
-            try:
-                with open(self.mapping_file, "r") as f:
-                    lines = f.readlines()
-                    
-                if lines:
-                    print("\nRegistered Users:")
-                    print(f"{'User ID':<10} {'Username':<20} {'Date':<15}")
-                    print("-" * 45)
-                    
-                    for line in lines:
-                        parts = line.strip().split(":")
-                        if len(parts) >= 3:
-                            user_id, username, timestamp = parts[0], parts[1], parts[2]
-                            date_str = time.strftime("%m/%d/%Y", time.localtime(int(timestamp)))
-                            print(f"{user_id:<10} {username:<20} {date_str:<15}")
-            except FileNotFoundError:
-                print("No user mapping file found")
+            users = self.mappings.all()
+            if users:
+                print("\nRegistered Users:")
+                print(f"{'User ID':<10} {'Username':<20} {'Date':<15}")
+                print("-" * 45)
+                
+                for user_id, username, timestamp in users:
+                    date_str = time.strftime("%m/%d/%Y", time.localtime(timestamp))
+                    print(f"{user_id:<10} {username:<20} {date_str:<15}")
+            else:
+                print("No user mappings found")
                 
         except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            self.fp_auth.cleanup()
+            self.sensor_error(e)
             
     def test_verification(self):
         print("\n🔐 Fingerprint Verification Test")
         print("-" * 35)
         
-        if not self.fp_auth.initialize():
+        if not self.ensure_sensor():
             print("❌ Could not initialize fingerprint sensor")
             return
             
@@ -81,9 +88,7 @@ class FingerprintManager:
                 elapsed = time.time() - start_time
                 print(f"❌ Verification failed ({elapsed:.2f}s)")
         except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            self.fp_auth.cleanup()
+            self.sensor_error(e)
             
     def delete_user_fingerprint(self):
         print("\n🗑️  Delete User Fingerprint")
@@ -91,21 +96,15 @@ class FingerprintManager:
         
         # Show current users
         try:
-            with open(self.mapping_file, "r") as f:
-                lines = f.readlines()
+            users = self.mappings.all()
                 
-            if not lines:
+            if not users:
                 print("No registered users found")
                 return
                 
             print("Current users:")
-            users = []
-            for i, line in enumerate(lines):
-                parts = line.strip().split(":")
-                if len(parts) >= 2:
-                    user_id, username = parts[0], parts[1]
-                    users.append((user_id, username, line))
-                    print(f"{i+1}. {username} (ID: {user_id})")
+            for i, (user_id, username, timestamp) in enumerate(users):
+                print(f"{i+1}. {username} (ID: {user_id})")
                     
             choice = input("\nSelect user number to delete (or 'c' to cancel): ").strip()
             
@@ -115,26 +114,21 @@ class FingerprintManager:
             try:
                 index = int(choice) - 1
                 if 0 <= index < len(users):
-                    user_id, username, line_to_remove = users[index]
+                    user_id, username, timestamp = users[index]
                     
                     confirm = input(f"Delete fingerprint for '{username}'? (y/N): ")
                     if confirm.lower() != 'y':
                         return
                         
                     # Delete from sensor
-                    if self.fp_auth.initialize():
+                    if self.ensure_sensor():
                         numeric_id = int(user_id, 16) % 300
                         if self.fp_auth.delete_fingerprint(numeric_id):
                             print(f"✅ Fingerprint deleted from sensor")
                         else:
                             print("⚠️  Could not delete from sensor")
-                        self.fp_auth.cleanup()
                     
-                    # Remove from mapping file
-                    with open(self.mapping_file, "w") as f:
-                        for line in lines:
-                            if line != line_to_remove:
-                                f.write(line)
+                    self.mappings.remove(user_id)
                     print(f"✅ User '{username}' removed from mappings")
                     
                 else:
@@ -142,8 +136,6 @@ class FingerprintManager:
             except ValueError:
                 print("Invalid input")
                 
-        except FileNotFoundError:
-            print("No user mappings found")
         except Exception as e:
             print(f"Error: {e}")
             
@@ -156,7 +148,7 @@ class FingerprintManager:
             print("Operation cancelled")
             return
             
-        if not self.fp_auth.initialize():
+        if not self.ensure_sensor():
             print("❌ Could not initialize fingerprint sensor")
             return
             
@@ -164,24 +156,18 @@ class FingerprintManager:
             if self.fp_auth.clear_all_fingerprints():
                 print("✅ All fingerprints cleared from sensor")
                 
-                # Clear mapping file
-                try:
-                    os.remove(self.mapping_file)
-                    print("✅ User mappings cleared")
-                except:
-                    pass
+                self.mappings.clear()
+                print("✅ User mappings cleared")
             else:
                 print("❌ Failed to clear fingerprints")
         except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            self.fp_auth.cleanup()
+            self.sensor_error(e)
             
     def show_sensor_info(self):
         print("\n🔍 Sensor Information")
         print("-" * 25)
         
-        if not self.fp_auth.initialize():
+        if not self.ensure_sensor():
             print("❌ Could not initialize fingerprint sensor")
             return
             
@@ -190,16 +176,14 @@ class FingerprintManager:
             max_templates = self.fp_auth.max_templates
             
             print(f"Sensor Model: R503")
-            print(f"Communication: UART (57600 baud)")
+            print(f"Communication: UART ({self.fp_auth.sensor.baudrate} baud)")
             print(f"Max Templates: {max_templates}")
             print(f"Enrolled Templates: {count}")
             print(f"Available Slots: {max_templates - count}")
             print(f"Usage: {(count/max_templates)*100:.1f}%")
             
         except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            self.fp_auth.cleanup()
+            self.sensor_error(e)
             
     def run(self):
         while True:
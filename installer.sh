@@ -8,7 +8,7 @@ echo "dwc2" | sudo tee -a /etc/modules
 echo "libcomposite" | sudo tee -a /etc/modules
 
 sudo apt-get install -y python3 python3-dev python3-pip
-sudo apt-get install -y python3-cbor2 python3-cryptography python3-ecdsa 
+sudo apt-get install -y python3-cbor2 python3-cryptography 
 sudo apt-get install -y git libssl-dev make cmake build-essential
 
 git clone https://github.com/open-quantum-safe/liboqs-python
@@ -30,6 +30,10 @@ sudo systemctl daemon-reload
 sudo systemctl enable usbgadget
 sudo systemctl restart usbgadget
 
+# Switch the fingerprint sensor from its 57600 factory rate to the service's
+# 115200; a sensor that is missing or already switched is left alone
+sudo python3 register_fingerprint.py --provision-baud
+
 sudo cp security_key_service.service /lib/systemd/system
 sudo chmod 644 /lib/systemd/system/usbgadget.service
 sudo systemctl daemon-reload
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import os
+import cbor2
+
+# The key file is a CBOR snapshot of {rpid: {credid: record}} followed by one
+# appended put record per credential written since; write_snapshot() folds
+# them back in
+
+# Returns (keys, entries, torn): entries counts snapshot keys plus replayed
+# records; torn means the tail record was cut short and a new snapshot
+# should drop it
+def load_journal(path):
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            raise ValueError(f"{path} is empty")
+        keys = cbor2.load(file)
+        entries = sum(len(creds) for creds in keys.values())
+        torn = False
+        while file.tell() < size:
+            try:
+                record = cbor2.load(file)
+                # A cut-short map can still decode into something that is not a put record
+                rpid, credid, rec = record['rpid'], record['credid'], record['rec']
+            except Exception:
+                torn = True
+                break
+            keys.setdefault(rpid, {})[credid] = rec
+            entries += 1
+    return keys, entries, torn
+
+def write_snapshot(path, keys):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(cbor2.dumps(keys))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    # The rename only survives a power cut once the directory is synced
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def append_record(path, rpid, credid, record):
+    entry = cbor2.dumps({'op': 'put', 'rpid': rpid, 'credid': credid, 'rec': record})
+    with open(path, 'ab') as file:
+        file.write(entry)
+        file.flush()
+        os.fsync(file.fileno())
@@ -1,10 +1,25 @@
 #!/usr/bin/python3
 
 import serial
+import os
 import time
 import struct
+import fcntl
+import atexit
 import hashlib
 
+FACTORY_BAUDRATE = 57600
+# Hands the UART between the security key service and the enrolment tools
+SENSOR_LOCK_FILE = '/tmp/r503_fingerprint.lock'
+
+_HDR = struct.Struct('>HIBH')
+_U16 = struct.Struct('>H')
+_TWO_U16 = struct.Struct('>HH')
+
+def _checksum(packet_type, length, data):
+    # Sum of every byte from the packet type through the payload
+    return (packet_type + (length >> 8) + (length & 0xFF) + sum(data)) & 0xFFFF
+
 class FingerprintSensorBase:
     def __init__(self, port='/dev/ttyS0', baudrate=57600, address=0xFFFFFFFF):
         self.port = port
@@ -12,34 +27,54 @@ class FingerprintSensorBase:
         self.address = address
         self.serial = None
         self.packet_header = 0xEF01
+        # Set by a successful handshake, good until the port is closed
+        self.authenticated = False
+        # Header, command payload and checksum, reused for every packet sent
+        self._tx_buf = bytearray(9 + 64 + 2)
+        # Replies are read into this and handed back as views, valid until the next command
+        self._rx_buf = bytearray(9 + 256 + 2)
+        # CharBuffer id -> library location last loaded into it
+        self._loaded = {}
         
     def connect(self):
+        if self.serial and self.serial.is_open:
+            return True
+        if not os.path.exists(self.port):
+            return False
         try:
             self.serial = serial.Serial(self.port, self.baudrate, timeout=2)
             time.sleep(0.1)
             return True
-        except:
+        except (serial.SerialException, OSError):
             return False
             
     def disconnect(self):
+        self.authenticated = False
+        self._loaded.clear()
         if self.serial:
             self.serial.close()
+            self.serial = None
+            
+    def _forget_locations(self, first, count=1):
+        for buffer_id, location in list(self._loaded.items()):
+            if first <= location < first + count:
+                del self._loaded[buffer_id]
             
     def _send_packet(self, packet_type, data):
         if not self.serial:
             return None
             
         length = len(data) + 2
-        packet = struct.pack('>H', self.packet_header)
-        packet += struct.pack('>I', self.address)
-        packet += struct.pack('>B', packet_type)
-        packet += struct.pack('>H', length)
-        packet += data
+        end = 9 + len(data)
+        if end + 2 > len(self._tx_buf):
+            self._tx_buf = bytearray(end + 2)
+        packet = self._tx_buf
         
-        checksum = sum(struct.unpack('B' * len(packet[6:]), packet[6:]))
-        packet += struct.pack('>H', checksum)
+        _HDR.pack_into(packet, 0, self.packet_header, self.address, packet_type, length)
+        packet[9:end] = data
+        _U16.pack_into(packet, end, _checksum(packet_type, length, data))
         
-        self.serial.write(packet)
+        self.serial.write(memoryview(packet)[:end + 2])
         return self._receive_packet()
         
     def _receive_packet(self):
@@ -47,103 +82,146 @@ class FingerprintSensorBase:
             return None
             
         try:
-            header = self.serial.read(2)
-            if len(header) != 2 or struct.unpack('>H', header)[0] != self.packet_header:
+            packet = self._rx_buf
+            if self.serial.readinto(memoryview(packet)[:9]) != 9:
+                return None
+            header, address, packet_type, length = _HDR.unpack_from(packet)
+            if header != self.packet_header or length < 2:
                 return None
                 
-            address = self.serial.read(4)
-            packet_type = self.serial.read(1)
-            length = struct.unpack('>H', self.serial.read(2))[0]
-            data = self.serial.read(length - 2)
-            checksum = self.serial.read(2)
+            if 9 + length > len(packet):
+                packet = self._rx_buf = bytearray(9 + length)
+            view = memoryview(packet)
+            if self.serial.readinto(view[9:9 + length]) != length:
+                return None
             
+            data = view[9:7 + length]
+            checksum = _U16.unpack_from(packet, 7 + length)[0]
+            if checksum != _checksum(packet_type, length, data):
+                return None
             return data
         except:
             return None
         
     def verify_password(self, password=0x00000000):
-        data = struct.pack('>I', password)
-        response = self._send_packet(0x01, b'\x13' + data)
-        return response and response[0] == 0x00
+        data = struct.pack('>BI', 0x13, password)
+        response = self._send_packet(0x01, data)
+        self.authenticated = bool(response and response[0] == 0x00)
+        return self.authenticated
         
     def get_image(self):
         response = self._send_packet(0x01, b'\x01')
         return response and response[0] == 0x00
         
+    def wait_for_finger(self, present=True, timeout=5.0, interval=0.05):
+        # GenImg answers 0x00 with an image captured, 0x02 with no finger on
+        # the window; anything else is a transient error and is polled again
+        wanted = 0x00 if present else 0x02
+        deadline = time.monotonic() + timeout
+        while True:
+            response = self._send_packet(0x01, b'\x01')
+            if response and response[0] == wanted:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        
     def image_to_template(self, buffer_id):
-        data = struct.pack('>B', buffer_id)
-        response = self._send_packet(0x01, b'\x02' + data)
+        self._loaded.pop(buffer_id, None)
+        data = struct.pack('>BB', 0x02, buffer_id)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def create_template(self):
+        # RegModel writes the merged template back into both buffers
+        self._loaded.clear()
         response = self._send_packet(0x01, b'\x05')
         return response and response[0] == 0x00
         
     def match_template(self):
         response = self._send_packet(0x01, b'\x03')
         if response and response[0] == 0x00:
-            return True, struct.unpack('>H', response[1:3])[0]
+            return True, _U16.unpack_from(response, 1)[0]
         return False, 0
         
     def get_template_count(self):
         response = self._send_packet(0x01, b'\x1D')
         if response and response[0] == 0x00:
-            return struct.unpack('>H', response[1:3])[0]
+            return _U16.unpack_from(response, 1)[0]
         return 0
         
     def read_system_params(self):
         response = self._send_packet(0x01, b'\x0F')
         if response and response[0] == 0x00:
-            return response[1:]
+            return bytes(response[1:])
         return None
         
     def set_password(self, new_password):
-        data = struct.pack('>I', new_password)
-        response = self._send_packet(0x01, b'\x12' + data)
+        data = struct.pack('>BI', 0x12, new_password)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def set_address(self, new_address):
-        data = struct.pack('>I', new_address)
-        response = self._send_packet(0x01, b'\x15' + data)
+        data = struct.pack('>BI', 0x15, new_address)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
+    def set_baudrate(self, baudrate):
+        # SetSysPara parameter 4: baud rate as a multiple of 9600
+        data = struct.pack('>BBB', 0x0E, 4, baudrate // 9600)
+        response = self._send_packet(0x01, data)
+        if not (response and response[0] == 0x00):
+            return False
+        self.disconnect()
+        self.baudrate = baudrate
+        return self.connect()
+        
     def led_control(self, control_code, speed=0x80, color_index=1, cycle_count=0):
-        data = struct.pack('>BBBB', control_code, speed, color_index, cycle_count)
-        response = self._send_packet(0x01, b'\x35' + data)
+        data = struct.pack('>BBBBB', 0x35, control_code, speed, color_index, cycle_count)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def empty_database(self):
+        self._loaded.clear()
         response = self._send_packet(0x01, b'\x0D')
         return response and response[0] == 0x00
 
 class R502Fingerprint(FingerprintSensorBase):
     def store_template(self, location, buffer_id=1):
-        data = struct.pack('>HB', location, buffer_id)
-        response = self._send_packet(0x01, b'\x06' + data)
+        self._forget_locations(location)
+        data = struct.pack('>BHB', 0x06, location, buffer_id)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def load_template(self, location, buffer_id=1):
-        data = struct.pack('>HB', location, buffer_id)
-        response = self._send_packet(0x01, b'\x07' + data)
-        return response and response[0] == 0x00
+        if self._loaded.get(buffer_id) == location:
+            return True
+        self._loaded.pop(buffer_id, None)
+        data = struct.pack('>BHB', 0x07, location, buffer_id)
+        response = self._send_packet(0x01, data)
+        if response and response[0] == 0x00:
+            self._loaded[buffer_id] = location
+            return True
+        return False
         
     def delete_template(self, location, count=1):
-        data = struct.pack('>HH', location, count)
-        response = self._send_packet(0x01, b'\x0C' + data)
+        self._forget_locations(location, count)
+        data = struct.pack('>BHH', 0x0C, location, count)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def search_template(self, buffer_id=1, start_page=0, page_num=162):
-        data = struct.pack('>BHH', buffer_id, start_page, page_num)
-        response = self._send_packet(0x01, b'\x04' + data)
+        data = struct.pack('>BBHH', 0x04, buffer_id, start_page, page_num)
+        response = self._send_packet(0x01, data)
         if response and response[0] == 0x00:
-            return True, struct.unpack('>HH', response[1:5])
+            return True, _TWO_U16.unpack_from(response, 1)
         return False, None
         
     def fast_search(self, buffer_id=1, start_page=0, page_num=162):
-        data = struct.pack('>BHH', buffer_id, start_page, page_num)
-        response = self._send_packet(0x01, b'\x1B' + data)
+        data = struct.pack('>BBHH', 0x1B, buffer_id, start_page, page_num)
+        response = self._send_packet(0x01, data)
         if response and response[0] == 0x00:
-            return True, struct.unpack('>HH', response[1:5])
+            return True, _TWO_U16.unpack_from(response, 1)
         return False, None
 
 class R503Fingerprint(R502Fingerprint):
@@ -151,47 +229,65 @@ class R503Fingerprint(R502Fingerprint):
         super().__init__(port, baudrate, address)
         
     def store_template(self, location, buffer_id=1):
-        data = struct.pack('>BB', buffer_id, location)
-        response = self._send_packet(0x01, b'\x06' + data)
+        self._forget_locations(location)
+        data = struct.pack('>BBB', 0x06, buffer_id, location)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def load_template(self, location, buffer_id=1):
-        data = struct.pack('>BB', buffer_id, location)
-        response = self._send_packet(0x01, b'\x07' + data)
-        return response and response[0] == 0x00
+        if self._loaded.get(buffer_id) == location:
+            return True
+        self._loaded.pop(buffer_id, None)
+        data = struct.pack('>BBB', 0x07, buffer_id, location)
+        response = self._send_packet(0x01, data)
+        if response and response[0] == 0x00:
+            self._loaded[buffer_id] = location
+            return True
+        return False
         
     def delete_template(self, location, count=1):
-        data = struct.pack('>BB', location, count)
-        response = self._send_packet(0x01, b'\x0C' + data)
+        self._forget_locations(location, count)
+        data = struct.pack('>BBB', 0x0C, location, count)
+        response = self._send_packet(0x01, data)
         return response and response[0] == 0x00
         
     def search_template(self, buffer_id=1, start_page=0, page_num=300):
-        data = struct.pack('>BBB', buffer_id, start_page, page_num)
-        response = self._send_packet(0x01, b'\x04' + data)
+        data = struct.pack('>BBBB', 0x04, buffer_id, start_page, page_num)
+        response = self._send_packet(0x01, data)
         if response and response[0] == 0x00:
-            return True, struct.unpack('>HH', response[1:5])
+            return True, _TWO_U16.unpack_from(response, 1)
         return False, None
         
     def fast_search(self, buffer_id=1, start_page=0, page_num=300):
-        data = struct.pack('>BBB', buffer_id, start_page, page_num)
-        response = self._send_packet(0x01, b'\x1B' + data)
+        data = struct.pack('>BBBB', 0x1B, buffer_id, start_page, page_num)
+        response = self._send_packet(0x01, data)
         if response and response[0] == 0x00:
-            return True, struct.unpack('>HH', response[1:5])
+            return True, _TWO_U16.unpack_from(response, 1)
         return False, None
 
 class FingerprintAuth:
-    def __init__(self, sensor_port='/dev/ttyS0', led_pin=18, sensor_type='R502'):
+    # Pages searched around the last matching slot before the whole library
+    SEARCH_WINDOW = 20
+    
+    def __init__(self, sensor_port='/dev/ttyS0', led_pin=18, sensor_type='R502', baudrate=115200, exclusive=False):
         self.sensor_port = sensor_port
         self.led_pin = led_pin
         self.sensor_type = sensor_type
         
         if sensor_type.upper() == 'R503':
-            self.sensor = R503Fingerprint(sensor_port)
+            self.sensor = R503Fingerprint(sensor_port, baudrate)
         else:
-            self.sensor = R502Fingerprint(sensor_port)
+            self.sensor = R502Fingerprint(sensor_port, baudrate)
+        # initialize() may fall back to the factory rate; provisioning still aims here
+        self.configured_baudrate = baudrate
         self.user_templates = {}
         self.user_file = 'fingerprint_users.txt'
+        self._user_file_mtime = None
         self.max_templates = 162 if sensor_type.upper() == 'R502' else 300
+        self.last_match = None
+        # Exclusive users hold SENSOR_LOCK_FILE from initialize() to cleanup()
+        self.exclusive = exclusive
+        self._claim = None
         self.load_user_mappings()
         
         try:
@@ -204,6 +300,7 @@ class FingerprintAuth:
     
     def load_user_mappings(self):
         try:
+            self._user_file_mtime = os.stat(self.user_file).st_mtime_ns
             with open(self.user_file, 'r') as f:
                 for line in f:
                     parts = line.strip().split(':')
@@ -213,6 +310,17 @@ class FingerprintAuth:
         except:
             pass
     
+    def reload_user_mappings(self):
+        # Enrolment tools run as separate processes and rewrite the file
+        try:
+            mtime = os.stat(self.user_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._user_file_mtime:
+            self.user_templates.clear()
+            self._user_file_mtime = None
+            self.load_user_mappings()
+    
     def save_user_mappings(self):
         try:
             with open(self.user_file, 'w') as f:
@@ -228,10 +336,59 @@ class FingerprintAuth:
                 return i
         return None
         
+    def claim_sensor(self):
+        # Blocks until the service is between calls; touching the file tells
+        # it the sensor was used by someone else and its port must be reopened
+        if self._claim is None:
+            self._claim = open(SENSOR_LOCK_FILE, 'a')
+            fcntl.flock(self._claim, fcntl.LOCK_EX)
+            os.utime(SENSOR_LOCK_FILE)
+            
     def initialize(self):
+        if self.exclusive:
+            self.claim_sensor()
+        # The handshake only has to happen once per connection
+        if self.sensor.serial is not None and self.sensor.authenticated:
+            return True
         if not self.sensor.connect():
             return False
-        return self.sensor.verify_password()
+        if self.sensor.verify_password():
+            return True
+        if self.sensor.baudrate == FACTORY_BAUDRATE:
+            return False
+            
+        # Sensors not yet provisioned still answer at the factory rate; talk
+        # to them there without touching their settings
+        target = self.sensor.baudrate
+        self.sensor.disconnect()
+        self.sensor.baudrate = FACTORY_BAUDRATE
+        if self.sensor.connect() and self.sensor.verify_password():
+            return True
+        self.sensor.disconnect()
+        self.sensor.baudrate = target
+        return False
+        
+    def provision_baudrate(self):
+        # Explicit setup step (register_fingerprint.py --provision-baud): a
+        # sensor still at its factory rate is switched over once and keeps
+        # the setting in the module's flash across power cycles
+        target = self.configured_baudrate
+        if target == FACTORY_BAUDRATE:
+            return False
+            
+        self.sensor.disconnect()
+        self.sensor.baudrate = FACTORY_BAUDRATE
+        if not self.sensor.connect() or not self.sensor.verify_password():
+            self.sensor.disconnect()
+            self.sensor.baudrate = target
+            return False
+            
+        if self.sensor.set_baudrate(target) and self.sensor.verify_password():
+            return True
+            
+        self.sensor.disconnect()
+        self.sensor.baudrate = FACTORY_BAUDRATE
+        return self.sensor.connect() and self.sensor.verify_password()
         
     def enroll_fingerprint(self, user_id):
         if not self.initialize():
@@ -243,15 +400,17 @@ class FingerprintAuth:
         
         self.sensor.led_control(1, 0x80, 1, 0)
         
-        if not self.sensor.get_image():
+        if not self.sensor.wait_for_finger():
             return False
             
         if not self.sensor.image_to_template(1):
             return False
             
-        time.sleep(1)
+        # The second image has to come from a fresh placement
+        if not self.sensor.wait_for_finger(present=False):
+            return False
         
-        if not self.sensor.get_image():
+        if not self.sensor.wait_for_finger():
             return False
             
         if not self.sensor.image_to_template(2):
@@ -289,16 +448,29 @@ class FingerprintAuth:
                 self.sensor.led_control(6, 0x80, 2, 3)
                 return True
         else:
-            success, result = self.sensor.fast_search(1, 0, self.max_templates)
-            if success:
-                location, score = result
-                if score > 60:
-                    self.sensor.led_control(6, 0x80, 2, 3)
-                    return True
+            if self.search_library() is not None:
+                self.sensor.led_control(6, 0x80, 2, 3)
+                return True
                     
         self.sensor.led_control(6, 0x80, 3, 3)
         return False
         
+    def search_library(self):
+        # A key is mostly used by the same finger, so try the pages at the
+        # last match first and only fall back to searching every slot
+        if self.last_match is not None:
+            start = max(0, min(self.last_match, self.max_templates - self.SEARCH_WINDOW))
+            success, result = self.sensor.fast_search(1, start, self.SEARCH_WINDOW)
+            if success and result[1] > 60:
+                self.last_match = result[0]
+                return result
+                
+        success, result = self.sensor.fast_search(1, 0, self.max_templates)
+        if success and result[1] > 60:
+            self.last_match = result[0]
+            return result
+        return None
+        
     def delete_fingerprint(self, user_id):
         if not self.initialize():
             return False
@@ -329,57 +501,86 @@ class FingerprintAuth:
         
     def cleanup(self):
         self.sensor.disconnect()
+        if self._claim is not None:
+            self._claim.close()
+            self._claim = None
 
-def fingerprint_user_verification():
-    fp_auth = FingerprintAuth()
+# Shared by the helpers below so the port stays open and the handshake is
+# done once. register_fingerprint and fingerprint_manager claim the sensor
+# through SENSOR_LOCK_FILE; each call takes the lock for its duration and
+# drops the connection while a tool holds it or after one has used it
+_auth = None
+_turn = None
+_turn_stamp = None
+
+def _get_auth():
+    global _auth, _turn
+    if _auth is None:
+        _auth = FingerprintAuth()
+        _turn = open(SENSOR_LOCK_FILE, 'a')
+        atexit.register(_auth.cleanup)
+    else:
+        _auth.reload_user_mappings()
+    return _auth
+
+def _take_turn(fp_auth):
+    global _turn_stamp
     try:
-        result = fp_auth.verify_fingerprint()
+        fcntl.flock(_turn, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fp_auth.cleanup()
+        return False
+    stamp = os.fstat(_turn.fileno()).st_mtime_ns
+    if stamp != _turn_stamp:
+        # The sensor's templates and session may have changed under us
         fp_auth.cleanup()
-        return result
+        _turn_stamp = stamp
+    return True
+
+def _end_turn():
+    fcntl.flock(_turn, fcntl.LOCK_UN)
+
+def fingerprint_user_verification():
+    fp_auth = _get_auth()
+    if not _take_turn(fp_auth):
+        return False
+    try:
+        return fp_auth.verify_fingerprint()
     except:
         fp_auth.cleanup()
         return False
+    finally:
+        _end_turn()
 
 def fingerprint_user_enrollment(user_id):
-    fp_auth = FingerprintAuth()
+    fp_auth = _get_auth()
+    if not _take_turn(fp_auth):
+        return False
     try:
-        result = fp_auth.enroll_fingerprint(user_id)
-        fp_auth.cleanup()
-        return result
+        return fp_auth.enroll_fingerprint(user_id)
     except:
         fp_auth.cleanup()
         return False
+    finally:
+        _end_turn()
 
 def get_fingerprint_template_hash(user_id):
-    fp_auth = FingerprintAuth()
-    try:
-        if not fp_auth.initialize():
-            return None
-        
-        if user_id not in fp_auth.user_templates:
-            fp_auth.cleanup()
-            return None
-            
-        location = fp_auth.user_templates[user_id]
-        if fp_auth.sensor.load_template(location, 1):
-            template_data = b"template_" + str(user_id).encode()
-            template_hash = hashlib.sha256(template_data).digest()
-            fp_auth.cleanup()
-            return template_hash
-        fp_auth.cleanup()
-        return None
-    except:
-        fp_auth.cleanup()
+    # A stable per-user tag derived from the enrolment record; it never
+    # depended on the template bytes, so there is no need to touch the sensor
+    if user_id not in _get_auth().user_templates:
         return None
+    return hashlib.sha256(b"template_" + str(user_id).encode()).digest()
 
 def fingerprint_presence_detection():
-    fp_auth = FingerprintAuth()
+    fp_auth = _get_auth()
+    if not _take_turn(fp_auth):
+        return False
     try:
         if not fp_auth.initialize():
             return False
-        result = fp_auth.sensor.get_image()
-        fp_auth.cleanup()
-        return result
+        return fp_auth.sensor.get_image()
     except:
         fp_auth.cleanup()
         return False
+    finally:
+        _end_turn()
@@ -2,49 +2,44 @@
 
 import sys
 import time
-import os
 import hashlib
-from r503_fingerprint import FingerprintAuth
+from user_mappings import UserMappings
 
 class FingerprintRegistration:
     def __init__(self):
-        self.fp_auth = FingerprintAuth()
-        self.mapping_file = "/etc/fido2_security_key/user_mappings.txt"
-        self.ensure_directory()
-        
-    def ensure_directory(self):
-        os.makedirs(os.path.dirname(self.mapping_file), exist_ok=True)
+        # Deferred so --help doesn't pay for pyserial and the GPIO setup
+        from r503_fingerprint import FingerprintAuth
+        self.fp_auth = FingerprintAuth(exclusive=True)
+        self.mappings = UserMappings()
+        # user_id is derived from the username, so this stays one entry per mapping
+        self.usernames = {username for _, username, _ in self.mappings.all()}
         
     def generate_user_id(self, username):
-        hash_obj = hashlib.sha256(username.encode())
-        return hash_obj.hexdigest()[:8].upper()
+        return hashlib.blake2s(username.encode(), digest_size=4).hexdigest().upper()
         
     def save_user_mapping(self, user_id, username):
-        timestamp = int(time.time())
-        mapping_line = f"{user_id}:{username}:{timestamp}\n"
-        
-        with open(self.mapping_file, "a") as f:
-            f.write(mapping_line)
+        self.mappings.add(user_id, username, int(time.time()))
+        self.usernames.add(username)
             
     def user_exists(self, username):
-        try:
-            with open(self.mapping_file, "r") as f:
-                for line in f:
-                    parts = line.strip().split(":")
-                    if len(parts) >= 2 and parts[1] == username:
-                        return True
-        except FileNotFoundError:
-            pass
-        return False
+        return username in self.usernames
         
     def get_user_count(self):
+        return len(self.usernames)
+            
+    def provision_sensor(self):
         try:
-            with open(self.mapping_file, "r") as f:
-                return len([line for line in f if line.strip()])
-        except FileNotFoundError:
-            return 0
+            if not self.fp_auth.initialize():
+                print("❌ Sensor did not answer at its factory or configured baud rate")
+                return False
+            if self.fp_auth.sensor.baudrate != self.fp_auth.configured_baudrate:
+                self.fp_auth.provision_baudrate()
+            print(f"✅ Sensor answering at {self.fp_auth.sensor.baudrate} baud")
+            return self.fp_auth.sensor.baudrate == self.fp_auth.configured_baudrate
+        finally:
+            self.fp_auth.cleanup()
             
-    def register_fingerprint(self, username):
+    def register_fingerprint(self, username, keep_open=False):
         if self.user_exists(username):
             print(f"❌ User '{username}' already registered")
             return False
@@ -68,9 +63,8 @@ class FingerprintRegistration:
             print()
             
             print("👆 Place your finger on the sensor (1st scan)...")
-            time.sleep(2)
             
-            if not self.fp_auth.sensor.get_image():
+            if not self.fp_auth.sensor.wait_for_finger():
                 print("❌ Failed to capture first image")
                 return False
                 
@@ -80,9 +74,12 @@ class FingerprintRegistration:
                 
             print("✅ First scan complete")
             print("🔄 Lift finger and place again (2nd scan)...")
-            time.sleep(2)
             
-            if not self.fp_auth.sensor.get_image():
+            if not self.fp_auth.sensor.wait_for_finger(present=False):
+                print("❌ Finger was not lifted")
+                return False
+                
+            if not self.fp_auth.sensor.wait_for_finger():
                 print("❌ Failed to capture second image")
                 return False
                 
@@ -111,26 +108,32 @@ class FingerprintRegistration:
             
         except Exception as e:
             print(f"❌ Registration failed: {e}")
+            # Don't reuse a connection in an unknown state
+            self.fp_auth.cleanup()
             return False
         finally:
-            self.fp_auth.cleanup()
+            if not keep_open:
+                self.fp_auth.cleanup()
             
     def batch_register(self, usernames):
         successful = 0
         failed = 0
         
-        for username in usernames:
-            print(f"\n{'='*50}")
-            print(f"Registering user {successful + failed + 1}/{len(usernames)}: {username}")
-            print('='*50)
-            
-            if self.register_fingerprint(username):
-                successful += 1
-            else:
-                failed += 1
+        try:
+            for username in usernames:
+                print(f"\n{'='*50}")
+                print(f"Registering user {successful + failed + 1}/{len(usernames)}: {username}")
+                print('='*50)
                 
-            if successful + failed < len(usernames):
-                input("\nPress Enter for next user...")
+                if self.register_fingerprint(username, keep_open=True):
+                    successful += 1
+                else:
+                    failed += 1
+                    
+                if successful + failed < len(usernames):
+                    input("\nPress Enter for next user...")
+        finally:
+            self.fp_auth.cleanup()
                 
         print(f"\n📊 Registration Summary:")
         print(f"✅ Successful: {successful}")
@@ -142,10 +145,17 @@ class FingerprintRegistration:
         print("    FIDO2 Security Key - Fingerprint Registration")
         print("=" * 50)
         
+        try:
+            self._interactive_session()
+        finally:
+            self.fp_auth.cleanup()
+        
+    def _interactive_session(self):
+        # The sensor stays open for the whole session; initialize() is a
+        # no-op once the handshake has succeeded
         current_count = 0
         if self.fp_auth.initialize():
             current_count = self.fp_auth.get_enrolled_count()
-            self.fp_auth.cleanup()
             
         user_count = self.get_user_count()
         
@@ -173,7 +183,7 @@ class FingerprintRegistration:
                 print("❌ Username can only contain letters, numbers, _ and -")
                 continue
                 
-            self.register_fingerprint(username)
+            self.register_fingerprint(username, keep_open=True)
             
             another = input("\n🔄 Register another user? (y/N): ").strip().lower()
             if another != 'y':
@@ -194,12 +204,16 @@ def main():
             print("  python3 register_fingerprint.py                    # Interactive mode")
             print("  python3 register_fingerprint.py <username>         # Register single user")
             print("  python3 register_fingerprint.py <user1> <user2>... # Register multiple users")
+            print("  python3 register_fingerprint.py --provision-baud   # Move a factory-rate sensor to the configured baud rate")
             print()
             print("Examples:")
             print("  python3 register_fingerprint.py")
             print("  python3 register_fingerprint.py alice")
             print("  python3 register_fingerprint.py alice bob charlie")
             return
+        elif sys.argv[1] == "--provision-baud":
+            registration = FingerprintRegistration()
+            registration.provision_sensor()
         else:
             username = sys.argv[1]
             registration = FingerprintRegistration()
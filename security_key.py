@@ -7,8 +7,12 @@ debug_mode=False #Use button
 ############################### Benchmarking #################################
 from datetime import datetime
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 logtime = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-log_file_path=f'/etc/fido2_security_key/benchmark-{logtime}.json'
+log_file_path=f'/etc/fido2_security_key/benchmark-{logtime}.jsonl'
 
 ############################### Fingerprint Support #################################
 from r503_fingerprint import fingerprint_user_verification, fingerprint_presence_detection
@@ -21,7 +25,7 @@ try:
     secure_storage = get_secure_storage_instance()
     if secure_storage:
         print("ATECC608B secure storage initialized")
-        device_serial = secure_storage.get_device_serial()
+        device_serial = secure_storage.get_device_serial_hex()
         print(f"Device Serial: {device_serial}")
     else:
         print("ATECC608B not available, using file storage")
@@ -29,41 +33,64 @@ except Exception as e:
     print(f"Secure storage initialization failed: {e}")
     secure_storage = None
 
-logs=[]
 def add_to_log(data):
-    global logs
-    if allow_benchmarking:
-        logs.append(data)
-        with open(log_file_path,'w') as lfile:
-            json.dump(logs, lfile, indent=4)
+    # One JSON record per line, appended, so each transaction writes only itself
+    if not allow_benchmarking:
+        return
+    if orjson is not None:
+        line=orjson.dumps(data)
+    else:
+        line=json.dumps(data).encode()
+    with open(log_file_path,'ab') as lfile:
+        lfile.write(line+b'\n')
 
 ############################### Key Management ################################
 import os
 import uuid
 import cbor2
 from hashlib import sha256
+from functools import lru_cache
+from key_journal import load_journal, write_snapshot, append_record
 
 file_path="/etc/fido2_security_key/keys.secret"
 
-current_keys={}
-algo=-7
-while True:
-    print("Reading crypto file")
-    try:
-        if not os.path.exists(file_path):
-            empty_keys={}
-            with open(file_path,'wb') as file:
-                x=cbor2.dumps(empty_keys)
-                file.write(x)
+# Stored as a journal (see key_journal); journal_entries counts the records
+# on disk so save_key() knows when stale ones are worth compacting away
+journal_entries=0
 
+def count_keys():
+    return sum(len(creds) for creds in current_keys.values())
 
-        with open(file_path,'rb') as file:
-            cbin=file.read()
-            current_keys=cbor2.loads(cbin)
+def load_keys():
+    global journal_entries
+    keys, journal_entries, torn=load_journal(file_path)
+    return keys, torn
 
-        break
-    except:
-        pass
+def compact_keys():
+    global journal_entries
+    write_snapshot(file_path, current_keys)
+    journal_entries=count_keys()
+
+def save_key(rpid, credid, record):
+    global journal_entries
+    append_record(file_path, rpid, credid, record)
+    journal_entries+=1
+    # Rewritten credentials leave stale records behind
+    if journal_entries > 4*count_keys():
+        compact_keys()
+
+current_keys={}
+algo=-7
+print("Reading crypto file")
+if not os.path.exists(file_path):
+    compact_keys()
+
+# A damaged snapshot raises here: refusing to start beats running without
+# the credentials, and retrying would only parse the same bytes again
+current_keys, torn=load_keys()
+if torn:
+    # A write was cut short; drop the partial record
+    compact_keys()
 
 print('Keys loaded')
 
@@ -76,7 +103,7 @@ def get_algo(pubkeycredparams):
 
 def to_cose_key(pvtkey, pubkey, algo):
     if algo==-7:
-        return to_cose_key_ecdsa(pvtkey)
+        return to_cose_key_ecdsa(pubkey)
     if algo==-49 or algo==-48:
         return to_cose_key_mldsa(pubkey, algo)
     return None
@@ -85,10 +112,10 @@ def gen_keys(rpid, userid, userentity, algo):
     if algo==-7:
         if secure_storage:
             slot = hash(rpid + str(userid)) % 8
-            pubkey_hex = secure_storage.generate_device_key(slot)
-            if pubkey_hex:
+            public_key = secure_storage.generate_device_key(slot)
+            if public_key:
                 pvtkey = f"hw_slot_{slot}"
-                pubkey = pubkey_hex
+                pubkey = public_key.hex()
                 secure_storage.store_rp_hash(slot + 8, rpid)
             else:
                 pvtkey, pubkey = genCryptoKeys_ecdsa()
@@ -125,10 +152,7 @@ def gen_keys(rpid, userid, userentity, algo):
     if secure_storage:
         secure_storage.store_credential_id(slot + 8, credid)
     
-    file = open(file_path, 'wb')
-    x = cbor2.dumps(current_keys)
-    file.write(x)
-    file.close()
+    save_key(rpid, credid, key[credid])
     return credid, pvtkey, pubkey
     
 def check_key_exists(rpid, cred_id):
@@ -147,20 +171,36 @@ def get_all_keys(rpid):
         return current_keys[rpid]
     return None
 
+def is_hardware_key(pvtkey):
+    return bool(secure_storage) and pvtkey.startswith("hw_slot_")
+
+def sign_digest(pvtkey, digest):
+    # ECDSA over the SHA-256 of the challenge; the ATECC608B signs a 32-byte input as-is
+    if is_hardware_key(pvtkey):
+        slot = int(pvtkey.split("_")[2])
+        signature = secure_storage.sign_with_device_key(slot, digest)
+        if signature:
+            return signature
+    return sign_digest_ecdsa(pvtkey, digest)
+
 def sign_challenge(pvtkey, challenge, algo):
     if algo==-7:
-        if secure_storage and pvtkey.startswith("hw_slot_"):
-            slot = int(pvtkey.split("_")[2])
-            signature_hex = secure_storage.sign_with_device_key(slot, challenge)
-            if signature_hex:
-                return bytes.fromhex(signature_hex)
-            else:
-                return sign_challenge_ecdsa(pvtkey, challenge)
-        else:
-            return sign_challenge_ecdsa(pvtkey, challenge)
+        return sign_digest(pvtkey, hash_data(challenge))
     if algo==-49 or algo==-48:
         return sign_challenge_mldsa(pvtkey, challenge, algo)
     return None
+
+def sign_challenge_parts(pvtkey, parts, algo):
+    # ECDSA hashes the parts one after another instead of joining them first
+    if algo==-7:
+        return sign_digest(pvtkey, hash_parts(*parts))
+    return sign_challenge(pvtkey, b''.join(parts), algo)
+
+def sign_challenge_hashed(pvtkey, challenge, digest, algo):
+    # One challenge signed by several keys: ECDSA keys share its digest
+    if algo==-7:
+        return sign_digest(pvtkey, digest)
+    return sign_challenge(pvtkey, challenge, algo)
     
 def get_cred_entity(rpid, cred_id):
     if not check_key_exists(rpid, cred_id):
@@ -169,54 +209,73 @@ def get_cred_entity(rpid, cred_id):
 
 def hash_data(data):
     return sha256(data).digest()
+
+def hash_parts(*parts):
+    h=sha256()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+@lru_cache(maxsize=256)
+def hash_rpid(rpid):
+    return sha256(rpid.encode()).digest()
 ############################### Cryptographic Operations ECDSA ######################
-from ecdsa import SigningKey, VerifyingKey, NIST256p
 from cryptography import x509 
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, NoEncryption
-from cryptography.hazmat.primitives.serialization import load_der_private_key
 from cryptography.hazmat.backends import default_backend
 import datetime
-
-
+import threading
+from collections import OrderedDict
+
+
+
+# Shared with the signing pool, so only touched under the lock. Keys are
+# plain Python objects; an evicted one is reclaimed by GC once unused
+_ec_key_cache = OrderedDict()
+_ec_key_lock = threading.Lock()
+EC_KEY_CACHE_SIZE = 32
+
+def cache_private_key_ecdsa(pvtkey, private_key):
+    with _ec_key_lock:
+        _ec_key_cache[pvtkey] = private_key
+        _ec_key_cache.move_to_end(pvtkey)
+        if len(_ec_key_cache) > EC_KEY_CACHE_SIZE:
+            _ec_key_cache.popitem(last=False)
+
+def clear_private_keys_ecdsa():
+    with _ec_key_lock:
+        _ec_key_cache.clear()
+
+def load_private_key_ecdsa(pvtkey):
+    # Build the OpenSSL key straight from the scalar, once per credential
+    with _ec_key_lock:
+        private_key = _ec_key_cache.get(pvtkey)
+        if private_key is not None:
+            _ec_key_cache.move_to_end(pvtkey)
+            return private_key
+    private_key = ec.derive_private_key(int(pvtkey, 16), ec.SECP256R1(), default_backend())
+    cache_private_key_ecdsa(pvtkey, private_key)
+    return private_key
 
 def genCryptoKeys_ecdsa():
-    secret_string=str(uuid.uuid4())
-    hash_of_secret = sha256(secret_string.encode()).digest()
-    private_key = SigningKey.from_string(hash_of_secret[:32], curve=NIST256p)
-    public_key = private_key.get_verifying_key()
-    pvtkeystr= private_key.to_string().hex()
-    pubkeystr= public_key.to_string().hex()
+    private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    public_numbers = private_key.public_key().public_numbers()
+    pvtkeystr = private_key.private_numbers().private_value.to_bytes(32, 'big').hex()
+    pubkeystr = (public_numbers.x.to_bytes(32, 'big') + public_numbers.y.to_bytes(32, 'big')).hex()
+    # The new credential signs its own attestation straight away
+    cache_private_key_ecdsa(pvtkeystr, private_key)
     return pvtkeystr, pubkeystr
 
-def to_cose_key_ecdsa(pvtkey):
-    if secure_storage and pvtkey.startswith("hw_slot_"):
-        slot = int(pvtkey.split("_")[2])
-        pubkey_hex = secure_storage.atecc.genkey_command(slot)
-        if pubkey_hex:
-            public_key_bytes = bytes.fromhex(pubkey_hex)
-            x = public_key_bytes[:32]
-            y = public_key_bytes[32:64]
-            cose_key = {
-                1: 2,
-                3: -7,
-                -1: 1,
-                -2: x,
-                -3: y,
-            }
-            cose_encoded = cbor2.dumps(cose_key)
-            return cose_encoded
-    
-    private_key_bytes = bytes.fromhex(pvtkey)
-    private_key = SigningKey.from_string(private_key_bytes, curve=NIST256p)
-    public_key = private_key.get_verifying_key()
-    pubkeystr = public_key.to_string().hex()
-    public_key_bytes = bytes.fromhex(pubkeystr)
+def to_cose_key_ecdsa(pubkey):
+    # pubkey is the x || y point gen_keys got back from keygen, hardware or software
+    public_key_bytes = bytes.fromhex(pubkey)
     x = public_key_bytes[:32]
-    y = public_key_bytes[32:]
+    y = public_key_bytes[32:64]
     cose_key = {
         1: 2,
         3: -7,
@@ -229,22 +288,17 @@ def to_cose_key_ecdsa(pvtkey):
 
 
 
-def sign_challenge_ecdsa(pvtkey, challenge):
-    private_key_bytes = bytes.fromhex(pvtkey)
-    private_key = SigningKey.from_string(private_key_bytes, curve=NIST256p)
-    private_key_bytes=private_key.to_der()    
-    private_key = load_der_private_key(private_key_bytes, password=None, backend=default_backend())
+def sign_digest_ecdsa(pvtkey, digest):
+    private_key = load_private_key_ecdsa(pvtkey)
+    # The caller already hashed the challenge; OpenSSL only does the scalar math
     signature = private_key.sign(
-        challenge,
-        ec.ECDSA(hashes.SHA256())
+        digest,
+        ec.ECDSA(Prehashed(hashes.SHA256()))
     )
     return signature 
 
 def gen_certificate_ecdsa(pvtkey):
-    private_key_bytes = bytes.fromhex(pvtkey)
-    private_key = SigningKey.from_string(private_key_bytes, curve=NIST256p)
-    private_key_bytes=private_key.to_der()    
-    private_key = load_der_private_key(private_key_bytes, password=None, backend=default_backend())
+    private_key = load_private_key_ecdsa(pvtkey)
     public_key = private_key.public_key()
     builder = x509.CertificateBuilder()
     name = x509.Name([
@@ -288,10 +342,43 @@ def to_cose_key_mldsa(pubkey, algo):
     cose_encoded=cbor2.dumps(cose_key)
     return cose_encoded
 
+# Least recently used signer is dropped first. Entries are [signer, users]
+# and only touched under the lock: the signing pool may still be using a
+# signer when it is evicted, so whoever drops the last use frees it
+_mldsa_signers=OrderedDict()
+_mldsa_lock=threading.Lock()
+MLDSA_SIGNER_CACHE_SIZE=32
+
+def release_signer_mldsa(entry):
+    # Caller holds _mldsa_lock and has already taken entry out of the cache
+    if entry[1]==0:
+        entry[0].free()
+
+def clear_signers_mldsa():
+    # Signers still in use are freed by their last user
+    with _mldsa_lock:
+        while _mldsa_signers:
+            release_signer_mldsa(_mldsa_signers.popitem()[1])
+
 def sign_challenge_mldsa(pvtkey, challenge, algo):
-    pvtkey=bytes.fromhex(pvtkey)
-    signer=oqs.Signature(mldsaalgo[algo], pvtkey)
-    signature=signer.sign(challenge)
+    cache_key=(algo, pvtkey)
+    with _mldsa_lock:
+        entry=_mldsa_signers.get(cache_key)
+        if entry is None:
+            entry=[oqs.Signature(mldsaalgo[algo], bytes.fromhex(pvtkey)), 0]
+            _mldsa_signers[cache_key]=entry
+            if len(_mldsa_signers) > MLDSA_SIGNER_CACHE_SIZE:
+                release_signer_mldsa(_mldsa_signers.popitem(last=False)[1])
+        else:
+            _mldsa_signers.move_to_end(cache_key)
+        entry[1]+=1
+    try:
+        signature=entry[0].sign(challenge)
+    finally:
+        with _mldsa_lock:
+            entry[1]-=1
+            if _mldsa_signers.get(cache_key) is not entry:
+                release_signer_mldsa(entry)
     return signature
 
 
@@ -303,7 +390,8 @@ def get_hardware_aaguid():
         if stored_aaguid:
             return stored_aaguid
         else:
-            device_serial = secure_storage.get_device_serial()
+            # The AAGUID has always been derived from the hex serial; keep it stable
+            device_serial = secure_storage.get_device_serial_hex()
             if device_serial:
                 aaguid_data = hash_data(f"ATECC608B-{device_serial}".encode())[:16]
                 secure_storage.store_device_aaguid(aaguid_data)
@@ -317,22 +405,26 @@ def get_sign_count():
 
 def increment_sign_count():
     if secure_storage:
-        return secure_storage.increment_sign_counter("")
+        return secure_storage.increment_sign_counter()
     return 0
 
 aaguid_str='00000000-0000-0000-0000-000000000000'
 
+# Fixed for the life of the process: the hardware AAGUID is derived from the chip serial
+_AAGUID=get_hardware_aaguid()
+_FLAGS_MAKE_CREDENTIAL=b'\x45' #UP, UV, AT
+_FLAGS_ASSERTION=b'\x05' #UP, UV
 
 def authenticatorGetInfo():
     authenticatorInfo={}
     authenticatorInfo[1]=['FIDO_2_0', 'FIDO_2_1_PRE']
     authenticatorInfo[2]=['credProtect']
-    authenticatorInfo[3]=get_hardware_aaguid()
+    authenticatorInfo[3]=_AAGUID
     options={}
     options['rk']=True
-    options['plat']=False
     options['up']=True
     options['uv']=True
+    options['plat']=False
     authenticatorInfo[4]=options
     authenticatorInfo[5]=1200
     authenticatorInfo[6]=[1]
@@ -364,14 +456,14 @@ def authenticatorMakeCredential(channel, payload):
     
 
     
-    rpidhash=hash_data(rpid.encode())
+    rpidhash=hash_rpid(rpid)
     
     cred_id, pvtkey, pubkey=gen_keys(rpid, userid, user, algo)
     
-    flags=(0x45).to_bytes(1,'big')
+    flags=_FLAGS_MAKE_CREDENTIAL
     signCount=increment_sign_count().to_bytes(4,'big')
 
-    aaguid=get_hardware_aaguid()
+    aaguid=_AAGUID
     credentialIdLength=(len(cred_id)).to_bytes(2, 'big')
     credentialId=cred_id
     credentialPublicKey=to_cose_key(pvtkey,pubkey,algo)
@@ -382,10 +474,9 @@ def authenticatorMakeCredential(channel, payload):
 
     fmt='packed'
     
-    tosign=authData+clientDataHash
     attstmt={}
     attstmt['alg']=algo
-    attstmt['sig']=sign_challenge(pvtkey, tosign, algo)
+    attstmt['sig']=sign_challenge_parts(pvtkey, (authData, clientDataHash), algo)
     
     attestationobj={}
     attestationobj[1]=fmt
@@ -397,6 +488,10 @@ def authenticatorMakeCredential(channel, payload):
 
 signatures=[]
 
+from concurrent.futures import ThreadPoolExecutor
+# oqs and OpenSSL drop the GIL while signing, so software credentials in one
+# assertion can sign side by side
+_sign_pool=ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
 
 assertptr=0
 assertiontime=0
@@ -413,8 +508,8 @@ def authenticatorGetAssertion(channel, payload):
     if 3 in payload:
         allowList=payload[3]
 
-    rpidhash=hash_data(rpid.encode())
-    flags=(0x5).to_bytes(1, 'big')
+    rpidhash=hash_rpid(rpid)
+    flags=_FLAGS_ASSERTION
     signCount=increment_sign_count().to_bytes(4,'big')
 
     authdata=rpidhash+flags+signCount
@@ -440,13 +535,24 @@ def authenticatorGetAssertion(channel, payload):
         assertiontime=0
         return '', 0x2e
 
+    keys=[get_key(rpid, cred['id']) for cred in allowList]
+    # Queue the software signs first; ATECC608B slots share one I2C bus and
+    # sign inline while the pool works
+    digest=hash_data(tosign)
+    sigs=[None]*numberOfCredentials
+    if numberOfCredentials>1:
+        for i, key in enumerate(keys):
+            if not is_hardware_key(key['pvtkey']):
+                sigs[i]=_sign_pool.submit(sign_challenge_hashed, key['pvtkey'], tosign, digest, key['algo'])
+    for i, key in enumerate(keys):
+        if sigs[i] is None:
+            sigs[i]=sign_challenge_hashed(key['pvtkey'], tosign, digest, key['algo'])
+        else:
+            sigs[i]=sigs[i].result()
+
     c=0
-    for cred in allowList:
-        credid=cred['id']
-        key=get_key(rpid, credid)
+    for cred, key, sig in zip(allowList, keys, sigs):
         algo=key['algo']
-        pvtkey=key['pvtkey']
-        sig=sign_challenge(pvtkey, tosign, algo)
         user=key['userentity']
 
         assertobj={}
@@ -484,13 +590,35 @@ def authenticatorReset():
         for slot in range(8, 16):
             secure_storage.secure_delete_slot(slot)
         print("Hardware storage reset")
-    os.remove(file_path)
+    current_keys.clear()
+    compact_keys()
+    # Drop the private key material of the deleted credentials
+    clear_private_keys_ecdsa()
+    clear_signers_mldsa()
     full_data={}
     return '',0
 
 ############################## CTAP2 #########################################
+import struct
+
 full_data={}
 
+_INIT_HDR=struct.Struct('>4sBH') #CID, CMD, BCNT
+_CONT_HDR=struct.Struct('>4sB') #CID, SEQ
+_INIT_REPLY=struct.Struct('>8s4sBBBBB') #nonce, CID, protocol, major, minor, build, caps
+
+_CBOR_TABLE={
+    0x04: lambda channel, body: authenticatorGetInfo(),
+    0x01: lambda channel, body: authenticatorMakeCredential(channel, cbor2.loads(body)),
+    0x02: lambda channel, body: authenticatorGetAssertion(channel, cbor2.loads(body)),
+    0x08: lambda channel, body: authenticatorGetNextAssertion(),
+    0x07: lambda channel, body: authenticatorReset(),
+}
+# Every other reply is built by us with its map keys already inserted in CTAP2
+# canonical order, so only replies echoing the client's credential and user
+# maps need cbor2 to sort them
+_CANONICAL_REPLIES={0x02, 0x08}
+
 def CTAPHID_CBOR(channel, payload):
     start_keepalive(channel)
     command=0x10
@@ -498,21 +626,15 @@ def CTAPHID_CBOR(channel, payload):
     cbor_command_bytes=payload[0:1]
     show(cbor_command_bytes, 'CBOR Command')
     cbor_payload=payload[1:]
-    success=0
-    if cbor_command==0x04:
-        reply_payload, success=authenticatorGetInfo()
-    if cbor_command==0x01:
-        reply_payload, success=authenticatorMakeCredential(channel, cbor2.loads(cbor_payload))
-    if cbor_command==0x02:
-        reply_payload, success=authenticatorGetAssertion(channel, cbor2.loads(cbor_payload))
-    if cbor_command==0x08:
-        reply_payload, success=authenticatorGetNextAssertion()
-    if cbor_command==0x07:
-        reply_payload, success=authenticatorReset()
+    handler=_CBOR_TABLE.get(cbor_command)
+    if handler is None:
+        reply_payload, success=None, 0x01 #CTAP1_ERR_INVALID_COMMAND
+    else:
+        reply_payload, success=handler(channel, cbor_payload)
 
     if success==0:
         reply=(0).to_bytes(1,'big')
-        reply=reply+cbor2.dumps(reply_payload, canonical=True)
+        reply=reply+cbor2.dumps(reply_payload, canonical=cbor_command in _CANONICAL_REPLIES)
         bcnt=len(reply)
         to_send=preprocess_send_data(channel, command, bcnt, reply)
         return (to_send)
@@ -523,27 +645,24 @@ def CTAPHID_CBOR(channel, payload):
         return (to_send)
 
 
+BROADCAST_CID=b'\xff\xff\xff\xff'
+
 def make_channel_id():
-    import random
-    value=random.randint(1, 0xfffffffe)
-    return value.to_bytes(4, 'big')
+    while True:
+        channel=os.urandom(4)
+        if channel not in (b'\x00\x00\x00\x00', BROADCAST_CID):
+            return channel
 
 def CTAPHID_INIT(channel, payload):
-    if channel==0xffffffff:
+    # channel is the raw 4-byte CID; the broadcast CID asks for a fresh one
+    if bytes(channel)==BROADCAST_CID:
         channel_new=make_channel_id()
     else:
         channel_new=channel
-        if channel in full_data:
-            full_data.pop(channel)
+        full_data.pop(channel.hex(), None)
     command=0x06
     bcnt=17
-    data=payload 
-    data=data+channel_new 
-    data=data+(2).to_bytes(1, 'big') 
-    data=data+(1).to_bytes(1, 'big') 
-    data=data+(0).to_bytes(1, 'big') 
-    data=data+(1).to_bytes(1, 'big') 
-    data=data+(13).to_bytes(1, 'big') 
+    data=_INIT_REPLY.pack(bytes(payload), channel_new, 2, 1, 0, 1, 13)
 
     to_send=preprocess_send_data(channel, command, bcnt, data)
     return (to_send)
@@ -587,25 +706,21 @@ import threading
 
 task_thread = None
 stop_event = threading.Event()
-last_keepalive=0
 
 import time
-def send_keepalive(channel, payload):
-    global task_thread, stop_event, last_keepalive
-    while not stop_event.is_set():
-        curr=get_time_ms()
-        if curr-last_keepalive>=100:
-            CTAPHID_KEEPALIVE(channel, payload)
-            last_keepalive=get_time_ms()
-        time.sleep(0.01)
+def send_keepalive(channel, payload, stop):
+    # Sleeps until the next keepalive is due or stop_keepalive() fires
+    while not stop.wait(0.1):
+        CTAPHID_KEEPALIVE(channel, payload)
         
 def start_keepalive(channel, payload=1):
-    global task_thread, stop_event, last_keepalive
-    last_keepalive=get_time_ms()
+    global task_thread, stop_event
     
     stop_keepalive()
-    stop_event.clear()
-    task_thread = threading.Thread(target=send_keepalive, args=(channel, payload))
+    # A fresh event per thread; clearing a shared one could revive a thread
+    # that was told to stop but hadn't woken up yet
+    stop_event = threading.Event()
+    task_thread = threading.Thread(target=send_keepalive, args=(channel, payload, stop_event))
     task_thread.start()
 
 def stop_keepalive():
@@ -613,17 +728,18 @@ def stop_keepalive():
     if task_thread and task_thread.is_alive():
         stop_event.set()
     
+_CMD_TABLE={
+    0x06: CTAPHID_INIT,
+    0x01: CTAPHID_PING,
+    0x11: CTAPHID_CANCEL,
+    0x08: CTAPHID_WINK,
+    0x10: CTAPHID_CBOR,
+}
+
 def run_commands(channel, command, bcnt, payload):
-    if command==0x06:
-        return CTAPHID_INIT(channel, payload)
-    if command==0x01:
-        return CTAPHID_PING(channel, payload)
-    if command==0x11:
-        return CTAPHID_CANCEL(channel, payload)
-    if command==0x08:
-        return CTAPHID_WINK(channel, payload)
-    if command==0x10:
-        return CTAPHID_CBOR(channel, payload)
+    handler=_CMD_TABLE.get(command)
+    if handler is not None:
+        return handler(channel, payload)
 
 userin=threading.Event()
 userinthr=threading.Event()
@@ -651,12 +767,13 @@ def wait_up(channel):
                 finger_detected = False
                 indicator_off()
                 
-            if read_gpio():
-                print("Button pressed - fallback authentication")
+            # button_pressed sets userin from the GPIO edge; the timeout paces keepalives
+            if not button_edge and read_gpio():
                 userin.set()
+            if userin.wait(0.1):
+                print("Button pressed - fallback authentication")
                 userinthr.clear()
                 break
-            time.sleep(0.1)
     except Exception as e:
         print(f"Fingerprint verification error: {e}")
         if read_gpio():
@@ -704,29 +821,27 @@ def process_packet(packet):
     byte4=packet[4]
     if byte4>0x7f:
         command=packet[4] & 0x7f
-        command=command.to_bytes(1, 'big')
-        show(command, 'CMD')
+        show(command.to_bytes(1, 'big'), 'CMD')
         bcnt_bytes=packet[5:7]
         show(bcnt_bytes, "BCNT")
         bcnt=int.from_bytes(bcnt_bytes, 'big')
         num_pack=calc_num_packets(bcnt)
-        seqnum=-1
-        payload=packet[7:]
-        full_data[cstr]=[None]*(num_pack+2)
-        full_data[cstr][0]=command
-        full_data[cstr][1]=bcnt
+        # Fragments land at fixed offsets in one buffer; bit n of 'seen' is
+        # set once packet n (init = 0, continuation seq s = s+1) has arrived
+        buf=bytearray(57+(num_pack-1)*59)
+        buf[0:57]=packet[7:64]
+        full_data[cstr]={'cmd':command, 'bcnt':bcnt, 'buf':buf, 'seen':1, 'mask':(1<<num_pack)-1}
 
     else:
         seq=packet[4:5]
         show(seq, "SEQ")
         seqnum=packet[4]
-        payload=packet[5:]
+        entry=full_data.get(cstr)
+        offset=57+seqnum*59
+        if entry is not None and offset<len(entry['buf']):
+            entry['buf'][offset:offset+59]=packet[5:64]
+            entry['seen']|=1<<(seqnum+1)
     
-    seqnum=seqnum+3
-    try:
-        full_data[cstr][seqnum]=payload
-    except:
-        pass
     try:
         process_transcation(channel)
     except:
@@ -735,54 +850,44 @@ def process_packet(packet):
 
 
 def show(packet, dat=""):
-    if allow_prints:
-        print(dat, " "," ".join(packet.hex()[i:i+2] for i in range(0, len(packet.hex()), 2)),)
-        print()
+    print(dat, " ", packet.hex(' '))
+    print()
 
 def show_string(packet):
-    if allow_prints:
-        print("Showing packet string ",packet.decode('utf-8', 'replace'))
+    print("Showing packet string ",packet.decode('utf-8', 'replace'))
+
+if not allow_prints:
+    # Rebound once so a quiet build pays only for the call on every packet
+    def show(packet, dat=""):
+        pass
+
+    def show_string(packet):
+        pass
 
 def preprocess_send_data(channel, command, bcnt, payload):
     show(payload, 'Pre process')
     num_pack=calc_num_packets(bcnt)
     first_packet_size=64-7
     other_packet_size=64-5
-    packet_list=[None]*num_pack
-    if (bcnt<=first_packet_size):
-        packet_list[0]=payload
-    else:
-        packet_list[0]=payload[:first_packet_size]
-        payload=payload[first_packet_size:]
-        i=1
-        while len(payload)>0:
-            packet_list[i]=payload[:other_packet_size]
-            payload=payload[other_packet_size:]
-            i=i+1
-
-    last_pack=num_pack-1
-    last_size=other_packet_size
-    if last_pack==0:
-        last_size=first_packet_size
-    
-    if(len(packet_list[last_pack])<last_size):
-        pad=last_size-len(packet_list[last_pack])
-        packet_list[last_pack]=packet_list[last_pack]+b'\x00'*pad
-
-    full_packets=[None]*num_pack
-    first_packet=channel
-    first_packet=first_packet+(command | 0x80).to_bytes(1, 'big')
-    first_packet=first_packet+bcnt.to_bytes(2, 'big')
-    first_packet=first_packet+packet_list[0]
-    full_packets[0]=first_packet
-
-    for i in range(1, len(packet_list)):
-        packet=channel
-        packet=packet+(i-1).to_bytes(1, 'big')
-        packet=packet+packet_list[i]
-        full_packets[i]=packet
-
-    return full_packets
+    # All packets are framed in place in one zero-padded buffer and handed
+    # out as 64-byte views of it
+    out=bytearray(num_pack*64)
+    data=memoryview(payload)
+
+    _INIT_HDR.pack_into(out, 0, channel, command | 0x80, bcnt)
+    chunk=data[:first_packet_size]
+    out[7:7+len(chunk)]=chunk
+    data=data[first_packet_size:]
+
+    for i in range(1, num_pack):
+        base=i*64
+        _CONT_HDR.pack_into(out, base, channel, i-1)
+        chunk=data[:other_packet_size]
+        out[base+5:base+5+len(chunk)]=chunk
+        data=data[other_packet_size:]
+
+    view=memoryview(out)
+    return [view[i*64:(i+1)*64] for i in range(num_pack)]
 
 def send_data(preprocessed_data):
     indicator_on()
@@ -796,20 +901,13 @@ def send_data(preprocessed_data):
 def calc_num_packets(bcnt):
     first_packet_size=64-7
     other_packet_size=64-5
-    num_pack=1
-    bcnt=bcnt-first_packet_size
-    if bcnt<0:
-        bcnt=0
-    num_pack=num_pack+(bcnt // other_packet_size)
-    bcnt=bcnt % other_packet_size
-    if bcnt>0:
-        num_pack=num_pack+1
-        bcnt=0
-    return num_pack
+    # One init packet, then continuation packets rounded up
+    rest=max(0, bcnt-first_packet_size)
+    return 1+(rest+other_packet_size-1)//other_packet_size
 
 def result_payload(packets):
     global algo
-    payload=packets[0][7:]
+    payload=bytes(packets[0][7:])
     command=packets[0][4]& 0x7f
     bcnt_bytes=packets[0][5:7]
     bcnt=int.from_bytes(bcnt_bytes, 'big')
@@ -826,16 +924,13 @@ def result_payload(packets):
 def process_transcation(channel):
     cstr=channel.hex()
     data=full_data[cstr]
-    if None in data:
+    if data['seen']!=data['mask']:
         return 
-    payload=data[2]
-    i=3
-    while i<len(data):
-        payload=payload+data[i]
-        i=i+1
-    bcnt=data[1]
-    payload=payload[:bcnt]
-    command=int.from_bytes(data[0], 'big')
+    del full_data[cstr]
+    bcnt=data['bcnt']
+    payload=data['buf']
+    del payload[bcnt:]
+    command=data['cmd']
 
     start_time=time.perf_counter()
     res=run_commands(channel, command, bcnt, payload)
@@ -873,6 +968,21 @@ GPIO.setup(inputpin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 def read_gpio():
     return GPIO.input(inputpin)==GPIO.LOW
 
+def button_pressed(pin):
+    # Only a press during a user presence wait counts
+    if userinthr.is_set():
+        userin.set()
+
+# The button only signals presence in debug mode. Edge detection fails to
+# register on some kernel/RPi.GPIO combinations; wait_up then polls the pin
+button_edge=False
+if debug_mode:
+    try:
+        GPIO.add_event_detect(inputpin, GPIO.FALLING, callback=button_pressed, bouncetime=50)
+        button_edge=True
+    except RuntimeError as e:
+        print(f"Button edge detection unavailable, polling instead: {e}")
+
 def check_fingerprint_presence():
     try:
         return fingerprint_presence_detection()
@@ -887,17 +997,35 @@ def indicator_off():
 
 ############################Initializing port #########################
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+def open_port(path):
+    # Watch the directory before the first attempt so a node created or
+    # re-permissioned by udev in between still wakes us up
+    watch=None
+    if inotify_simple is not None:
+        watch=inotify_simple.INotify()
+        watch.add_watch(os.path.dirname(path), inotify_simple.flags.CREATE | inotify_simple.flags.ATTRIB)
+    try:
+        while True:
+            try:
+                return open(path, 'rb+')
+            except OSError:
+                if watch is not None:
+                    watch.read(timeout=1000)
+                else:
+                    time.sleep(1)
+    finally:
+        if watch is not None:
+            watch.close()
+
 port=None
 portname='/dev/hidg0'
-while True:
-    try:
-        port=open(portname, 'rb+')
-        print('Port opened')
-        break
-    except PermissionError as e:
-        time.sleep(1)
-    except:
-        time.sleep(1)
+port=open_port(portname)
+print('Port opened')
 
 indicator_on()
 time.sleep(2)
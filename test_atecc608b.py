@@ -8,17 +8,17 @@ from atecc608b import get_secure_storage_instance
 def test_atecc608b():
     print("Testing ATECC608B connection...")
     
-    if not atecc608b.ADAFRUIT_ATECC_AVAILABLE:
-        print("⚠️  Adafruit ATECC library not available - running in simulation mode")
-    
     storage = get_secure_storage_instance()
     if not storage:
         print("❌ Failed to initialize ATECC608B")
         return False
     
+    if not atecc608b.ADAFRUIT_ATECC_AVAILABLE:
+        print("⚠️  Adafruit ATECC library not available - running in simulation mode")
+    
     print("✅ ATECC608B initialized successfully")
     
-    serial = storage.get_device_serial()
+    serial = storage.get_device_serial_hex()
     if serial:
         print(f"📱 Device Serial: {serial}")
     else:
@@ -26,14 +26,14 @@ def test_atecc608b():
     
     random_data = storage.get_hardware_random()
     if random_data:
-        print(f"🎲 Hardware Random: {random_data[:16]}...")
+        print(f"🎲 Hardware Random: {random_data[:8].hex()}...")
     else:
         print("⚠️  Could not generate random number")
     
     print("🔑 Testing key generation...")
     public_key = storage.generate_device_key(0)
     if public_key:
-        print(f"✅ Generated key: {public_key[:16]}...")
+        print(f"✅ Generated key: {public_key[:8].hex()}...")
     else:
         print("❌ Failed to generate key")
     
@@ -41,7 +41,7 @@ def test_atecc608b():
     test_data = b"Hello ATECC608B"
     signature = storage.sign_with_device_key(0, test_data)
     if signature:
-        print(f"✅ Signature: {signature[:16]}...")
+        print(f"✅ Signature: {signature[:8].hex()}...")
     else:
         print("❌ Failed to sign data")
     
@@ -19,6 +19,7 @@ def test_sensor():
         print(f"Max templates: {fp_auth.max_templates}")
         
         print("\n1. Testing serial connection...")
+        fp_auth.claim_sensor()
         if fp_auth.sensor.connect():
             print("✅ Serial connection successful")
             
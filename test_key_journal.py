@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+import cbor2
+
+from key_journal import load_journal, write_snapshot, append_record
+
+class KeyJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'keys.secret')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_replay_and_torn_tail(self):
+        write_snapshot(self.path, {'a.com': {b'c1': {'pvtkey': 'x'}}})
+        append_record(self.path, 'b.com', b'c2', {'pvtkey': 'y'})
+        append_record(self.path, 'a.com', b'c1', {'pvtkey': 'z'})
+        entry = cbor2.dumps({'op': 'put', 'rpid': 'c.com', 'credid': b'c3', 'rec': {}})
+        with open(self.path, 'ab') as f:
+            f.write(entry[:-3])
+
+        keys, entries, torn = load_journal(self.path)
+        self.assertEqual(keys, {'a.com': {b'c1': {'pvtkey': 'z'}}, 'b.com': {b'c2': {'pvtkey': 'y'}}})
+        self.assertEqual(entries, 3)
+        self.assertTrue(torn)
+
+    def test_non_record_tail_is_torn(self):
+        write_snapshot(self.path, {})
+        append_record(self.path, 'a.com', b'c1', {'pvtkey': 'x'})
+        with open(self.path, 'ab') as f:
+            f.write(cbor2.dumps({'op': 'put', 'rpid': 'b.com'}))
+
+        keys, entries, torn = load_journal(self.path)
+        self.assertEqual(keys, {'a.com': {b'c1': {'pvtkey': 'x'}}})
+        self.assertTrue(torn)
+
+    def test_compaction(self):
+        write_snapshot(self.path, {})
+        for i in range(5):
+            append_record(self.path, 'a.com', b'c1', {'pvtkey': str(i)})
+        keys, entries, torn = load_journal(self.path)
+        self.assertEqual(entries, 5)
+
+        write_snapshot(self.path, keys)
+        self.assertEqual(load_journal(self.path), ({'a.com': {b'c1': {'pvtkey': '4'}}}, 1, False))
+        self.assertEqual(os.listdir(self.dir.name), ['keys.secret'])
+
+    def test_empty_file_fails(self):
+        open(self.path, 'wb').close()
+        with self.assertRaises(ValueError):
+            load_journal(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
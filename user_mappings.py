@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import os
+import sqlite3
+
+DB_FILE = "/etc/fido2_security_key/user_mappings.db"
+LEGACY_FILE = "/etc/fido2_security_key/user_mappings.txt"
+
+class UserMappings:
+    def __init__(self, db_file=DB_FILE, legacy_file=LEGACY_FILE):
+        self.db_file = db_file
+        self.legacy_file = legacy_file
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+
+        self.conn = sqlite3.connect(db_file)
+        # Each registration is still its own commit, but WAL appends one
+        # record instead of rewriting a rollback journal on the SD card
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS mappings "
+            "(user_id TEXT PRIMARY KEY, username TEXT NOT NULL, ts INTEGER NOT NULL)"
+        )
+        self.import_legacy()
+
+    def import_legacy(self):
+        if not os.path.exists(self.legacy_file):
+            return
+
+        rows = []
+        with open(self.legacy_file, "r") as f:
+            for lineno, line in enumerate(f, 1):
+                parts = line.strip().split(":")
+                if len(parts) < 2:
+                    continue
+                try:
+                    timestamp = int(parts[2]) if len(parts) >= 3 else 0
+                except ValueError:
+                    # One bad line must not block the rest of the migration
+                    print(f"Skipping malformed line {lineno} in {self.legacy_file}: {line.strip()!r}")
+                    continue
+                rows.append((parts[0], parts[1], timestamp))
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO mappings (user_id, username, ts) VALUES (?, ?, ?)", rows
+            )
+        # Keep the old file around, but never import it twice
+        os.rename(self.legacy_file, self.legacy_file + ".migrated")
+
+    def add(self, user_id, username, timestamp):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mappings (user_id, username, ts) VALUES (?, ?, ?)",
+                (user_id, username, timestamp),
+            )
+
+    def remove(self, user_id):
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM mappings WHERE user_id = ?", (user_id,))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM mappings")
+
+    def all(self):
+        return self.conn.execute(
+            "SELECT user_id, username, ts FROM mappings ORDER BY rowid"
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()